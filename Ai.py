@@ -1,51 +1,57 @@
 import os
-import json
-import re
-from typing import Dict, Any, Tuple
+import asyncio
+import threading
+from typing import Callable, Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
-import google.generativeai as genai
+from gemini_client import GeminiAssistant, dump_state, normalize_input
 
 load_dotenv()
 
-
-def run_digaxy_ai(user_input: str, session_state: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
-    """
-    Conversational moving estimator using Gemini.
-    LLM handles extraction, reasoning, and cost estimation.
-    session_state only maintains conversation memory.
-    """
-    
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        return "System Error: Gemini API key missing.", session_state
-    
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("gemini-2.5-flash")
-
-    master_prompt = f"""
+BOOKING_URL = "http://localhost:3000/book"
+
+# Base fare and per-minute labor rate for each vehicle
+VEHICLE_RATES = {
+    "Pickup": {"base": 42.92, "per_min": 1.62},
+    "Van": {"base": 77.00, "per_min": 2.02},
+    "Minibox": {"base": 144.51, "per_min": 2.30},
+    "Bigbox": {"base": 230.00, "per_min": 4.99},
+}
+DISTANCE_RATE_PER_KM = 0.80
+
+# Appended to the reply once the user has booked
+BOOKING_LINK_SUFFIX = f"\n\n🔗 **Complete your booking here:**\n{BOOKING_URL}"
+
+# Fields the assistant collects into session_state["fields"]
+STATE_FIELDS = (
+    "service_type",
+    "vehicle_type",
+    "pickup_location",
+    "dropoff_location",
+    "item_description",
+)
+
+_RATE_LINES = "\n".join(
+    f"            {name}: ${rate['base']:.2f} base | ${rate['per_min']:.2f}/min labor  "
+    for name, rate in VEHICLE_RATES.items()
+)
+
+# Invariant instructions, sent once as the model's system instruction so the
+# provider can reuse the cached prefix; each turn only sends state + message.
+SYSTEM_PROMPT = f"""
             You are the **Digaxy AI Moving Assistant**, a professional logistics dispatcher.
 
             Your job is to help users estimate moving costs conversationally.
 
             Users may provide information gradually across multiple messages.
-            You MUST use the existing session_state to remember previous information.
+            You MUST use the CURRENT SESSION STATE sent with each message to remember previous information.
 
             --------------------------------------------------
 
             ### KNOWLEDGE BASE (Rates)
 
-            Pickup: $42.92 base | $1.62/min labor  
-            Van: $77.00 base | $2.02/min labor  
-            Minibox: $144.51 base | $2.30/min labor  
-            Bigbox: $230.00 base | $4.99/min labor  
-
-            Distance surcharge: $0.80 per KM
-
-            --------------------------------------------------
-
-            ### CURRENT SESSION STATE
+{_RATE_LINES}
 
-            {json.dumps(session_state)}
+            Distance surcharge: ${DISTANCE_RATE_PER_KM:.2f} per KM
 
             --------------------------------------------------
 
@@ -86,7 +92,7 @@ def run_digaxy_ai(user_input: str, session_state: Dict[str, Any]) -> Tuple[str,
 
             6. COST FORMULA
 
-            Total = Base + (Distance_KM × 0.80) + (Labor_Mins × Labor_Rate)
+            Total = Base + (Distance_KM × {DISTANCE_RATE_PER_KM:.2f}) + (Labor_Mins × Labor_Rate)
 
             Round money values to 2 decimals.
 
@@ -117,13 +123,7 @@ def run_digaxy_ai(user_input: str, session_state: Dict[str, Any]) -> Tuple[str,
 
             If user confirms booking, respond:
 
-            "Great! Please complete your booking here: http://localhost:3000/book"
-
-            --------------------------------------------------
-
-            ### USER MESSAGE
-
-            "{user_input}"
+            "Great! Please complete your booking here: {BOOKING_URL}"
 
             --------------------------------------------------
 
@@ -149,37 +149,95 @@ def run_digaxy_ai(user_input: str, session_state: Dict[str, Any]) -> Tuple[str,
             }}
 """
 
-    try:
-        response = model.generate_content(master_prompt)
-        
-        # Extract the JSON block from the LLM response safely
-        json_match = re.search(r'\{[\s\S]*\}', response.text)
-        if not json_match:
-            return "Error: Invalid response format. Please try again.", session_state
-        
-        clean_text = json_match.group()
-        data = json.loads(clean_text)
-        
-        # If the user confirmed, append the booking link to the message
-        if data["updated_state"]["status"] == "booked":
-            data["message"] += "\n\n🔗 **Complete your booking here:**\nhttp://localhost:3000/book"
+# Structured-output schema for the reply; Gemini returns a body that parses
+# directly with json.loads.
+RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "message": {"type": "STRING"},
+        "updated_state": {
+            "type": "OBJECT",
+            "properties": {
+                "fields": {
+                    "type": "OBJECT",
+                    "properties": {
+                        name: {"type": "STRING"}
+                        for name in STATE_FIELDS
+                    },
+                },
+                "calculation": {
+                    "type": "OBJECT",
+                    "properties": {
+                        name: {"type": "NUMBER"} for name in ("distance_km", "labor_mins", "total_cost")
+                    },
+                },
+                "status": {"type": "STRING", "enum": ["collecting", "confirming", "booked"]},
+            },
+            "required": ["fields", "calculation", "status"],
+        },
+    },
+    "required": ["message", "updated_state"],
+}
+
+
+_ASSISTANT = GeminiAssistant(SYSTEM_PROMPT, RESPONSE_SCHEMA)
+
+
+def _turn_prompt(user_input: str, session_state: Dict[str, Any]) -> str:
+    return f"""
+            ### CURRENT SESSION STATE
 
-        return data["message"], data["updated_state"]
+            {dump_state(session_state)}
+
+            --------------------------------------------------
+
+            ### USER MESSAGE
+
+            "{user_input}"
+"""
+
+
+def _append_booking_link(message: str, updated_state: Dict[str, Any]) -> str:
+    # If the user confirmed, append the booking link to the message
+    if updated_state["status"] == "booked":
+        return message + BOOKING_LINK_SUFFIX
+    return message
+
+
+async def run_digaxy_ai_async(
+    user_input: str,
+    session_state: Dict[str, Any],
+    on_message: Optional[Callable[[str], None]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Conversational moving estimator using Gemini.
+    LLM handles extraction, reasoning, and cost estimation.
+    session_state only maintains conversation memory.
+    Awaits the Gemini call so concurrent sessions share one event loop.
+    on_message, if given, receives the reply text incrementally while it streams.
+    """
+    return await _ASSISTANT.respond_async(
+        session_state,
+        _turn_prompt(user_input, session_state),
+        normalize_input(user_input),
+        on_message,
+        finalize=_append_booking_link,
+    )
+
+
+def run_digaxy_ai(user_input: str, session_state: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Blocking variant of run_digaxy_ai_async."""
+    return _ASSISTANT.respond(
+        session_state,
+        _turn_prompt(user_input, session_state),
+        normalize_input(user_input),
+        finalize=_append_booking_link,
+    )
 
-    except json.JSONDecodeError as je:
-        print(f"JSON Error: {je}")
-        return "Error parsing response. Please try again.", session_state
-    
-    except Exception as e:
-        error_msg = str(e)
-        if "429" in error_msg or "quota" in error_msg.lower():
-            return "⚠️ API Quota Exceeded: Free tier limit reached. Try again tomorrow or upgrade at https://ai.google.dev", session_state
-        print(f"Error: {type(e).__name__}: {e}")
-        return "I'm sorry, I'm having trouble processing your request. Please try again.", session_state
 
 # --- TEST RUNNER (How your Backend calls it) ---
 
-if __name__ == "__main__":
+async def main():
     # INITIAL STATE (This would be stored in your Database/Redis)
     session = {
         "fields": {}, 
@@ -188,13 +246,33 @@ if __name__ == "__main__":
     }
     
     print("🚀 Digaxy AI Engine Online")
+
+    # Import and configure the Gemini SDK while the user types their first message.
+    # A daemon thread, so Ctrl-C at the prompt still exits; get_model is locked,
+    # so the first turn simply waits for it to finish.
+    api_key = os.getenv("GEMINI_API_KEY")
+    if api_key:
+        threading.Thread(target=_ASSISTANT.get_model, args=(api_key,), daemon=True).start()
     
     while True:
         user_in = input("\nYou: ")
         if user_in.lower() in ["exit", "quit"]: break
         
+        print("\nAssistant: ", end="", flush=True)
+        shown = []
+
+        def show(text):
+            shown.append(text)
+            print(text, end="", flush=True)
+
         # The single call
-        reply, session = run_digaxy_ai(user_in, session)
-        
-        print(f"\nAssistant: {reply}")
-        # print(f"\n[DEBUG STATE]: {json.dumps(session['fields'], indent=2)}")
\ No newline at end of file
+        reply, session = await run_digaxy_ai_async(user_in, session, on_message=show)
+
+        # Print whatever didn't stream (cache hits, errors, the booking link)
+        streamed = "".join(shown)
+        print(reply[len(streamed):] if reply.startswith(streamed) else f"\n{reply}")
+        # print(f"\n[DEBUG STATE]: {json.dumps(session['fields'], indent=2)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
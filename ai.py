@@ -1,46 +1,88 @@
-import os
-import json
 import re
-from typing import Dict, Any, Tuple
+from typing import Callable, Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
-import google.generativeai as genai
+from gemini_client import GeminiAssistant, dump_state, normalize_input
 
 load_dotenv()
 
+BOOKING_URL = "http://localhost:3000/book"
 
-def run_digaxy_ai(user_input: str, session_state: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
-    """
-    Conversational moving estimator using Gemini. 
-    LLM handles extraction, reasoning, and cost estimation.
-    session_state only maintains conversation memory.
-    """
-    
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        return "System Error: Gemini API key missing.", session_state
-    
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("gemini-2.5-flash")
+# Base fare, per-minute labor rate and typical load for each vehicle
+VEHICLE_RATES = {
+    "Pickup": {"base": 42.92, "per_min": 1.62, "fits": "single item"},
+    "Van": {"base": 77.00, "per_min": 2.02, "fits": "furniture, 5-15 boxes"},
+    "Minibox": {"base": 144.51, "per_min": 2.30, "fits": "20-40 boxes"},
+    "Bigbox": {"base": 230.00, "per_min": 4.99, "fits": "40+ boxes"},
+}
+DISTANCE_RATE_PER_KM = 0.80
+
+# Driving distances (km) for routes we quote often. Resolved locally so the
+# model is handed the figure instead of recalling it from the prompt.
+KNOWN_DISTANCES_KM = [
+    ("Lynbrook, NY", "Madison, NJ", 90),
+    ("Lynbrook, NY", "Newark, NJ", 45),
+    ("Manhattan, NY", "Boston, MA", 350),
+    ("Manhattan, NY", "Philadelphia, PA", 150),
+    ("Manhattan, NY", "Washington, DC", 360),
+    ("Manhattan, NY", "Los Angeles, CA", 4500),
+]
+
+# Short replies that mean the same thing to the dispatcher collapse onto
+# one cache key, so "Okay, sure." reuses the answer cached for "yes".
+# Only unambiguous replies belong here: "cancel" or "not now" may mean
+# something other than declining the current question.
+_AFFIRMATIVE_REPLIES = frozenset({
+    "yes", "y", "yeah", "yep", "yup", "sure", "ok", "okay", "okay sure", "ok sure",
+    "confirm", "confirmed", "proceed", "go ahead", "book", "book it", "yes please",
+    "sounds good", "let's do it", "lets do it",
+})
+_NEGATIVE_REPLIES = frozenset({
+    "no", "n", "nope", "nah", "no thanks", "no thank you",
+})
+_CANONICAL_REPLIES = {
+    **dict.fromkeys(_AFFIRMATIVE_REPLIES, "yes"),
+    **dict.fromkeys(_NEGATIVE_REPLIES, "no"),
+}
+# Punctuation ignored when matching a reply against the table above
+_REPLY_PUNCTUATION_RE = re.compile(r"[^\w\s']")
+
+# Fields the assistant collects into session_state["fields"]
+STATE_FIELDS = (
+    "item_description",
+    "pickup_location",
+    "dropoff_location",
+    "vehicle_type",
+    "service_type",
+)
+
+_RATE_LINES = "\n".join(
+    f"{name}: ${rate['base']:.2f} base + ${rate['per_min']:.2f}/min ({rate['fits']})"
+    for name, rate in VEHICLE_RATES.items()
+)
+_VEHICLE_OPTIONS = "\n".join(
+    f"{i}. **{name}** (${rate['base']:.2f})" for i, (name, rate) in enumerate(VEHICLE_RATES.items(), 1)
+)
 
-    master_prompt = f"""You are a moving dispatcher assistant. Help users get accurate moving estimates with CORRECT distances.
 
-### SESSION STATE
-{json.dumps(session_state)}
+def _normalize_place(place: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", place.lower().replace(".", "")).split())
+
+
+_ROUTE_DISTANCES = {
+    frozenset((_normalize_place(a), _normalize_place(b))): km for a, b, km in KNOWN_DISTANCES_KM
+}
+_KNOWN_DISTANCES_TEXT = "\n".join(f"{a} ↔ {b}: ~{km} km" for a, b, km in KNOWN_DISTANCES_KM)
+
+# Invariant instructions, sent once as the model's system instruction so the
+# provider can reuse the cached prefix; each turn only sends state + message.
+SYSTEM_PROMPT = f"""You are a moving dispatcher assistant. Help users get accurate moving estimates with CORRECT distances.
 
 ### PRICING
-Van: $77 base + $2.02/min (furniture, 5-15 boxes)
-Minibox: $144.51 base + $2.30/min (20-40 boxes)
-Bigbox: $230 base + $4.99/min (40+ boxes)
-Pickup: $42.92 base + $1.62/min (single item)
-Distance: $0.80/km
+{_RATE_LINES}
+Distance: ${DISTANCE_RATE_PER_KM:.2f}/km
 
 ### KNOWN DISTANCES (driving km)
-Lynbrook, NY ↔ Madison, NJ: ~90 km
-Lynbrook, NY ↔ Newark, NJ: ~45 km
-Manhattan, NY ↔ Boston, MA: ~350 km
-Manhattan, NY ↔ Philadelphia, PA: ~150 km
-Manhattan, NY ↔ Washington, DC: ~360 km
-Manhattan, NY ↔ Los Angeles, CA: ~4500 km
+{_KNOWN_DISTANCES_TEXT}
 
 IMPORTANT: Use these distances. If route not listed, estimate realistic driving distance (NOT 0 km unless same location). Add 20-30% to straight line distance for road routes.
 
@@ -76,7 +118,7 @@ CRITICAL: Do NOT use 0 km unless pickup and dropoff are the same location.
 - Always provide realistic highway distance.
 
 ### COST FORMULA (with CORRECT distance)
-total = base + (distance_km × 0.80) + (labor_mins × labor_rate)
+total = base + (distance_km × {DISTANCE_RATE_PER_KM:.2f}) + (labor_mins × labor_rate)
 labor_mins = 30 min minimum + (items_complexity × time_per_item)
 
 
@@ -87,10 +129,7 @@ When asking for info: Ask naturally for next missing field.
 
 When showing vehicles (after items + locations known):
 "Which vehicle works best for your move?
-1. **Pickup** ($42.92)
-2. **Van** ($77)
-3. **Minibox** ($144.51)
-4. **Bigbox** ($230)"
+{_VEHICLE_OPTIONS}"
 
 When recommending vehicle:
 "The **[VEHICLE]** would be the right choice for [ITEMS]. Proceed? (yes/no)"
@@ -108,10 +147,7 @@ Certainly! Here are the details for your moving estimate:
 Do you want to process the booking? (yes/no)
 
 When booking confirmed:
-Great! Complete your booking here: http://localhost:3000/book
-
-### USER MESSAGE
-"{user_input}"
+Great! Complete your booking here: {BOOKING_URL}
 
 ### RESPOND WITH STRICT JSON
 {{
@@ -134,29 +170,104 @@ Great! Complete your booking here: http://localhost:3000/book
 }}
 """
 
-    try:
-        response = model.generate_content(master_prompt)
-        
-        # Extract the JSON block from the LLM response safely
-        json_match = re.search(r'\{[\s\S]*\}', response.text)
-        if not json_match:
-            return "Error: Invalid response format. Please try again.", session_state
-        
-        clean_text = json_match.group()
-        data = json.loads(clean_text)
-        
-        return data["message"], data["updated_state"]
+# Structured-output schema for the reply; Gemini returns a body that parses
+# directly with json.loads.
+RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "message": {"type": "STRING"},
+        "updated_state": {
+            "type": "OBJECT",
+            "properties": {
+                "fields": {
+                    "type": "OBJECT",
+                    "properties": {
+                        name: {"type": "STRING", "nullable": True}
+                        for name in STATE_FIELDS
+                    },
+                },
+                "calculation": {
+                    "type": "OBJECT",
+                    "properties": {
+                        name: {"type": "NUMBER"} for name in ("distance_km", "labor_mins", "total_cost")
+                    },
+                },
+                "status": {"type": "STRING", "enum": ["collecting", "confirming", "booked"]},
+            },
+            "required": ["fields", "calculation", "status"],
+        },
+    },
+    "required": ["message", "updated_state"],
+}
+
+
+_ASSISTANT = GeminiAssistant(SYSTEM_PROMPT, RESPONSE_SCHEMA)
+
+
+def _normalize_input(user_input: str) -> str:
+    """Normalize the message for the cache key and canonicalize yes/no replies."""
+    text = normalize_input(user_input)
+    reply = " ".join(_REPLY_PUNCTUATION_RE.sub(" ", text.replace("’", "'")).split())
+    return _CANONICAL_REPLIES.get(reply, text)
+
+
+def lookup_distance_km(pickup: Optional[str], dropoff: Optional[str]) -> Optional[int]:
+    """Return the known driving distance between two places, or None if the route isn't listed."""
+    if not pickup or not dropoff:
+        return None
+    # Only fully qualified names match: a bare "Madison" or "Washington" may
+    # not be the listed place, and the model is told to use this figure as-is.
+    return _ROUTE_DISTANCES.get(frozenset((_normalize_place(pickup), _normalize_place(dropoff))))
+
+
+def _route_distance_note(session_state: Dict[str, Any]) -> str:
+    fields = session_state.get("fields") or {}
+    distance_km = lookup_distance_km(fields.get("pickup_location"), fields.get("dropoff_location"))
+    if distance_km is None:
+        return "Route not resolved yet."
+    return f"{fields['pickup_location']} → {fields['dropoff_location']}: {distance_km} km (use exactly this distance)"
+
+
+def _turn_prompt(user_input: str, session_state: Dict[str, Any]) -> str:
+    return f"""### SESSION STATE
+{dump_state(session_state)}
+
+### ROUTE DISTANCE (resolved for current session)
+{_route_distance_note(session_state)}
+
+### USER MESSAGE
+"{user_input}"
+"""
+
+
+async def run_digaxy_ai_async(
+    user_input: str,
+    session_state: Dict[str, Any],
+    on_message: Optional[Callable[[str], None]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Conversational moving estimator using Gemini. 
+    LLM handles extraction, reasoning, and cost estimation.
+    session_state only maintains conversation memory.
+    Awaits the Gemini call so concurrent sessions share one event loop.
+    on_message, if given, receives the reply text incrementally while it streams.
+    """
+    return await _ASSISTANT.respond_async(
+        session_state,
+        _turn_prompt(user_input, session_state),
+        _normalize_input(user_input),
+        on_message,
+    )
+
+
+def run_digaxy_ai(user_input: str, session_state: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Blocking variant of run_digaxy_ai_async."""
+    return _ASSISTANT.respond(
+        session_state,
+        _turn_prompt(user_input, session_state),
+        _normalize_input(user_input),
+    )
 
-    except json.JSONDecodeError as je:
-        print(f"JSON Error: {je}")
-        return "Error parsing response. Please try again.", session_state
-    
-    except Exception as e:
-        error_msg = str(e)
-        if "429" in error_msg or "quota" in error_msg.lower():
-            return "⚠️ API Quota Exceeded: Free tier limit reached. Try again tomorrow or upgrade at https://ai.google.dev", session_state
-        print(f"Error: {type(e).__name__}: {e}")
-        return "I'm sorry, I'm having trouble processing your request. Please try again.", session_state
 
 # --- TEST RUNNER (How your Backend calls it) ---
 
@@ -180,4 +291,4 @@ Great! Complete your booking here: http://localhost:3000/book
 #         print(f"\nAssistant: {reply}")
 #         # print(f"\n[DEBUG STATE]: {json.dumps(session['fields'], indent=2)}")
         
-#     # labor_mins = max(30, distance_km × 0.6)  # Dynamic based on distance: ~100 km/h average speed
\ No newline at end of file
+#     # labor_mins = max(30, distance_km × 0.6)  # Dynamic based on distance: ~100 km/h average speed
@@ -0,0 +1,306 @@
+import os
+import json
+import logging
+import re
+import threading
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "gemini-2.5-flash"
+
+# Upper bound on a single Gemini request, so a stalled call can't hang a session
+REQUEST_TIMEOUT_SECONDS = 30
+
+# Gemini responses keyed on (session_state, normalized user input).
+# Identical turns from different users skip the network round-trip.
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL_SECONDS = 86400
+
+# Fixed replies returned without going through the model
+REPLY_MISSING_KEY = "System Error: Gemini API key missing."
+REPLY_PARSE_ERROR = "Error parsing response. Please try again."
+REPLY_QUOTA_EXCEEDED = "⚠️ API Quota Exceeded: Free tier limit reached. Try again tomorrow or upgrade at https://ai.google.dev"
+REPLY_GENERIC_ERROR = "I'm sorry, I'm having trouble processing your request. Please try again."
+
+_MESSAGE_START_RE = re.compile(r'"message"\s*:\s*"')
+_LONE_SURROGATE_RE = re.compile("[\ud800-\udfff]")
+
+
+def dump_state(state: Dict[str, Any]) -> str:
+    """Compact, key-sorted JSON so identical states serialize to identical prompts."""
+    return json.dumps(state, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def normalize_input(user_input: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    return " ".join(user_input.lower().split()).strip(" .!?")
+
+
+class ResponseCache:
+    """Bounded LRU of Gemini replies with a TTL, keyed on session state plus normalized input."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, str, str]]" = OrderedDict()
+        # The blocking entry point may be called from several threads at once
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(cache_input: str, session_state: Dict[str, Any]) -> str:
+        raw = dump_state(session_state) + "\n" + cache_input
+        return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, message, state_json = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+        # Hand out a fresh copy so callers can't mutate the cached state
+        return message, json.loads(state_json)
+
+    def set(self, key: str, message: str, updated_state: Dict[str, Any]) -> None:
+        entry = (time.monotonic() + self.ttl_seconds, message, dump_state(updated_state))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class MessageStreamDecoder:
+    """
+    Incrementally decodes the "message" string of a streamed JSON reply.
+    Each feed() only looks at text that hasn't been consumed yet, so decoding
+    a whole stream is linear in its length.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._started = False
+        self.done = False
+
+    def feed(self, text: str) -> str:
+        """Add a chunk and return the message text it completes (possibly "")."""
+        if self.done:
+            return ""
+        self._buf += text
+
+        if not self._started:
+            match = _MESSAGE_START_RE.search(self._buf)
+            if not match:
+                # Keep only the tail that may hold a partially streamed key
+                keep = self._buf.rfind('"message"')
+                if keep < 0:
+                    keep = self._buf.rfind('"')
+                self._buf = self._buf[keep:] if keep >= 0 else ""
+                return ""
+            self._buf = self._buf[match.end():]
+            self._started = True
+
+        buf = self._buf
+        end = 0
+        while end < len(buf):
+            char = buf[end]
+            if char == '"':
+                self.done = True
+                break
+            if char != "\\":
+                end += 1
+                continue
+            # Stop before an escape sequence that hasn't fully arrived
+            if buf[end + 1:end + 2] != "u":
+                if end + 2 > len(buf):
+                    break
+                end += 2
+                continue
+            if end + 6 > len(buf):
+                break
+            if 0xD800 <= int(buf[end + 2:end + 6], 16) <= 0xDBFF:
+                # High surrogate: hold it back until its low half arrives
+                low = buf[end + 6:end + 12]
+                if len(low) < 6 and "\\u".startswith(low[:2]):
+                    break
+                end += 12 if low.startswith("\\u") else 6
+            else:
+                end += 6
+
+        self._buf = buf[end:]
+        decoded = json.loads('"' + buf[:end] + '"')
+        # A surrogate the model never paired can't be printed; show a placeholder
+        return _LONE_SURROGATE_RE.sub("\ufffd", decoded)
+
+
+class _ReplyCollector:
+    """Accumulates streamed reply chunks and forwards new message text to on_message."""
+
+    def __init__(self, on_message: Optional[Callable[[str], None]] = None):
+        self._on_message = on_message
+        self._decoder = MessageStreamDecoder()
+        self._parts = []
+
+    def feed(self, text: str) -> None:
+        self._parts.append(text)
+        if self._on_message is None:
+            return
+
+        try:
+            message = self._decoder.feed(text)
+        except ValueError:
+            # Malformed escape; the final parse reports it, stop streaming
+            self._on_message = None
+            return
+        if not message:
+            return
+
+        # A failing callback is the caller's problem, not a failed Gemini
+        # request: log it, stop streaming and still return the full reply.
+        try:
+            self._on_message(message)
+        except Exception:
+            logger.exception("on_message callback failed; not streaming the rest of this reply")
+            self._on_message = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+
+class GeminiAssistant:
+    """
+    One Gemini-backed assistant: a system prompt and response schema, the
+    model built from them on first use, and a response cache of its own.
+    respond() uses the SDK's blocking client and is safe to call from any
+    thread; respond_async() is for callers already on an event loop.
+    """
+
+    def __init__(self, system_prompt: str, response_schema: Dict[str, Any]):
+        self.system_prompt = system_prompt
+        self.response_schema = response_schema
+        self.cache = ResponseCache()
+        # Configured on first use; google.generativeai pulls in gRPC/protobuf
+        # and is slow to import. The one instance (and its client channel) is
+        # reused for every turn.
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    def get_model(self, api_key: str):
+        with self._model_lock:
+            if self._model is None:
+                import google.generativeai as genai
+
+                genai.configure(api_key=api_key)
+                self._model = genai.GenerativeModel(
+                    MODEL_NAME,
+                    system_instruction=self.system_prompt,
+                    generation_config={
+                        "response_mime_type": "application/json",
+                        "response_schema": self.response_schema,
+                    },
+                )
+            return self._model
+
+    def _prepare(self, session_state: Dict[str, Any], cache_input: str):
+        """Return (cache_key, model, early_reply); early_reply is set on a cache hit or a missing API key."""
+        cache_key = self.cache.key(cache_input, session_state)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cache_key, None, cached
+
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            return cache_key, None, (REPLY_MISSING_KEY, session_state)
+
+        return cache_key, self.get_model(api_key), None
+
+    def _finish(
+        self,
+        cache_key: str,
+        response_text: str,
+        finalize: Optional[Callable[[str, Dict[str, Any]], str]],
+    ) -> Tuple[str, Dict[str, Any]]:
+        data = json.loads(response_text)
+        # Same placeholder as the streamed text, so both agree and the reply prints
+        message = _LONE_SURROGATE_RE.sub("\ufffd", data["message"])
+        if finalize is not None:
+            message = finalize(message, data["updated_state"])
+
+        self.cache.set(cache_key, message, data["updated_state"])
+        return message, data["updated_state"]
+
+    @staticmethod
+    def _failure(error: Exception, session_state: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        if isinstance(error, json.JSONDecodeError):
+            logger.warning("Could not parse Gemini reply: %s", error)
+            return REPLY_PARSE_ERROR, session_state
+
+        error_msg = str(error)
+        if "429" in error_msg or "quota" in error_msg.lower():
+            logger.warning("Gemini quota exceeded: %s", error)
+            return REPLY_QUOTA_EXCEEDED, session_state
+        logger.error("Gemini request failed", exc_info=error)
+        return REPLY_GENERIC_ERROR, session_state
+
+    async def respond_async(
+        self,
+        session_state: Dict[str, Any],
+        prompt: str,
+        cache_input: str,
+        on_message: Optional[Callable[[str], None]] = None,
+        finalize: Optional[Callable[[str, Dict[str, Any]], str]] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Answer one turn. cache_input is the normalized user message used in the
+        cache key; on_message, if given, receives the reply text as it streams;
+        finalize, if given, rewrites the model's message before it is cached
+        and returned.
+        """
+        cache_key, model, early = self._prepare(session_state, cache_input)
+        if early is not None:
+            return early
+
+        try:
+            collector = _ReplyCollector(on_message)
+            response = await model.generate_content_async(
+                prompt, stream=True, request_options={"timeout": REQUEST_TIMEOUT_SECONDS}
+            )
+            async for chunk in response:
+                collector.feed(chunk.text)
+            return self._finish(cache_key, collector.text, finalize)
+        except Exception as e:
+            return self._failure(e, session_state)
+
+    def respond(
+        self,
+        session_state: Dict[str, Any],
+        prompt: str,
+        cache_input: str,
+        on_message: Optional[Callable[[str], None]] = None,
+        finalize: Optional[Callable[[str, Dict[str, Any]], str]] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """Blocking counterpart of respond_async, on the SDK's synchronous client."""
+        cache_key, model, early = self._prepare(session_state, cache_input)
+        if early is not None:
+            return early
+
+        try:
+            collector = _ReplyCollector(on_message)
+            response = model.generate_content(
+                prompt, stream=True, request_options={"timeout": REQUEST_TIMEOUT_SECONDS}
+            )
+            for chunk in response:
+                collector.feed(chunk.text)
+            return self._finish(cache_key, collector.text, finalize)
+        except Exception as e:
+            return self._failure(e, session_state)